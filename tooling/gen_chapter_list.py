@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import re, shutil
+import json, os, re
 from pathlib import Path
 from collections import defaultdict
 
@@ -12,22 +12,44 @@ DRIVER_TPL = CH_DIR / "chapter_driver_template.tex"
 SNIPPET_TPL = TIKZ_DIR / "_snippet_template.tikz.tex"
 
 CH_RE = re.compile(r"^(?P<ch>\d{1,2})_(?P<idx>\d+)_")
+# Touched after a successful run; tikzbot compares it against the PNG
+# mtimes to skip regeneration entirely on steady-state runs.
+STAMP = GEN_DIR / ".stamp"
+
+def _is_fresh(path, newest_input):
+    """True when path exists and is newer than all of its inputs."""
+    try:
+        return path.stat().st_mtime > newest_input
+    except FileNotFoundError:
+        return False
 
 def main():
     GEN_DIR.mkdir(parents=True, exist_ok=True)
     TIKZ_DIR.mkdir(parents=True, exist_ok=True)
 
+    # Read each template once instead of re-opening it per missing file.
+    snippet_bytes = SNIPPET_TPL.read_bytes()
+    driver_text = DRIVER_TPL.read_text(encoding="utf-8")
+    tpl_mtime = max(SNIPPET_TPL.stat().st_mtime, DRIVER_TPL.stat().st_mtime)
+
     buckets = defaultdict(list)  # ch -> [(idx, name, png)]
     misc = []
 
-    for png in sorted(PNG_DIR.glob("*.png")):
-        m = CH_RE.match(png.name)
-        if m:
-            ch = int(m.group("ch"))
-            idx = int(m.group("idx"))
-            buckets[ch].append((idx, png.stem, png))
-        else:
-            misc.append(png)
+    # Single scandir pass – avoids the per-entry stat() and Path
+    # construction of PNG_DIR.glob() on large asset dirs.
+    with os.scandir(PNG_DIR) as it:
+        for e in it:
+            if not e.name.endswith(".png"):
+                continue
+            stem = e.name[:-4]
+            mtime = e.stat(follow_symlinks=False).st_mtime
+            m = CH_RE.match(e.name)
+            if m:
+                ch = int(m.group("ch"))
+                idx = int(m.group("idx"))
+                buckets[ch].append((idx, stem, Path(e.path), mtime))
+            else:
+                misc.append((stem, Path(e.path), mtime))
 
     # per chapter
     for ch, items in sorted(buckets.items()):
@@ -38,47 +60,64 @@ def main():
 
         # ensure snippets exist
         snippet_rel_paths = []
-        for _, stem, _ in items:
+        manifest_rows = []
+        for _, stem, png, _ in items:
             snip = ch_snip_dir / f"{stem}.tikz.tex"
             if not snip.exists():
-                shutil.copyfile(SNIPPET_TPL, snip)
+                snip.write_bytes(snippet_bytes)
             snippet_rel_paths.append(Path("..")/ "tikz" / ch_slug / f"{stem}.tikz.tex")
+            manifest_rows.append({"stem": stem, "snippet": str(snip), "target": str(png)})
 
-        # write generated list
+        # write generated list + JSON manifest, unless no input changed
+        # since last time (the .tex list is for LaTeX, the .json is what
+        # tikzbot reads back)
         lst = GEN_DIR / f"{ch_slug}_list.tex"
-        with lst.open("w", encoding="utf-8") as f:
-            for rel in snippet_rel_paths:
-                f.write("\\begin{figurlab}\n  \\input{" + str(rel).replace('\\','/') + "}\n\\end{figurlab}\n\n")
+        manifest = GEN_DIR / f"{ch_slug}_list.json"
+        newest = max(max(mt for _, _, _, mt in items), tpl_mtime)
+        if not (_is_fresh(lst, newest) and _is_fresh(manifest, newest)):
+            body = "".join(
+                f"\\begin{{figurlab}}\n  \\input{{{rel.as_posix()}}}\n\\end{{figurlab}}\n\n"
+                for rel in snippet_rel_paths
+            )
+            lst.write_text(body, encoding="utf-8")
+            with manifest.open("w", encoding="utf-8") as f:
+                json.dump(manifest_rows, f)
 
         # ensure driver
         drv = CH_DIR / f"{ch_slug}_figs.tex"
         if not drv.exists():
-            text = DRIVER_TPL.read_text(encoding="utf-8")
-            text = text.replace("__CHAPTER__", ch_slug)
-            drv.write_text(text, encoding="utf-8")
+            drv.write_text(driver_text.replace("__CHAPTER__", ch_slug), encoding="utf-8")
 
     # misc
     if misc:
         misc_snip_dir = TIKZ_DIR / "misc"
         misc_snip_dir.mkdir(parents=True, exist_ok=True)
         snippet_rel_paths = []
-        for png in sorted(misc):
-            stem = png.stem
+        manifest_rows = []
+        for stem, png, _ in sorted(misc):
             snip = misc_snip_dir / f"{stem}.tikz.tex"
             if not snip.exists():
-                shutil.copyfile(SNIPPET_TPL, snip)
+                snip.write_bytes(snippet_bytes)
             snippet_rel_paths.append(Path("..")/ "tikz" / "misc" / f"{stem}.tikz.tex")
+            manifest_rows.append({"stem": stem, "snippet": str(snip), "target": str(png)})
 
         lst = GEN_DIR / "misc_list.tex"
-        with lst.open("w", encoding="utf-8") as f:
-            for rel in snippet_rel_paths:
-                f.write("\\begin{figurlab}\n  \\input{" + str(rel).replace('\\','/') + "}\n\\end{figurlab}\n\n")
+        manifest = GEN_DIR / "misc_list.json"
+        newest = max(max(mt for _, _, mt in misc), tpl_mtime)
+        if not (_is_fresh(lst, newest) and _is_fresh(manifest, newest)):
+            body = "".join(
+                f"\\begin{{figurlab}}\n  \\input{{{rel.as_posix()}}}\n\\end{{figurlab}}\n\n"
+                for rel in snippet_rel_paths
+            )
+            lst.write_text(body, encoding="utf-8")
+            with manifest.open("w", encoding="utf-8") as f:
+                json.dump(manifest_rows, f)
 
         drv = CH_DIR / "misc_figs.tex"
         if not drv.exists():
-            text = DRIVER_TPL.read_text(encoding="utf-8")
-            text = text.replace("__CHAPTER__", "misc")
-            drv.write_text(text, encoding="utf-8")
+            drv.write_text(driver_text.replace("__CHAPTER__", "misc"), encoding="utf-8")
+
+    STAMP.touch()
 
 if __name__ == "__main__":
     main()